@@ -0,0 +1,29 @@
+# -*- coding: utf-8 -*-
+# gunicorn keihi_server:app で自動的に読み込まれる設定
+# Claude API待ちやステータスのポーリングなどI/O待ちが中心なので、geventワーカーで同時接続をさばく
+
+import os
+
+from gevent import monkey, socket
+from gunicorn.workers.ggevent import GeventWorker
+
+
+class KeihiGeventWorker(GeventWorker):
+    """標準のgeventワーカーと同じだが、monkey.patch_all を aggressive=False で行う。
+    aggressive=True だと select.epoll 等が削除され、Anthropicクライアント作成時に
+    httpx経由で読み込まれるtrioが AttributeError で落ちてワーカーが起動しない"""
+
+    def patch(self):
+        # アプリ（anthropic/httpx/ssl）を読み込む前にソケット等をgevent対応に差し替える
+        monkey.patch_all(aggressive=False)
+        self.sockets = [socket.socket(s.FAMILY, socket.SOCK_STREAM, fileno=s.sock.detach())
+                        for s in self.sockets]
+
+
+bind = f"0.0.0.0:{os.environ.get('PORT', '10000')}"
+worker_class = KeihiGeventWorker
+worker_connections = 1000
+# ジョブの進捗(JOBS)はプロセス内のdictなので、ワーカーは1プロセスにまとめる
+# （複数にするとポーリングが別プロセスに振られてジョブが見つからなくなる）
+workers = 1
+timeout = 120
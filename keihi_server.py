@@ -3,28 +3,71 @@
 🧾 KeihiAI - 経費精算自動化サーバー
 ======================================
 起動方法:
-1. pip install flask flask-cors pillow openpyxl anthropic
+1. pip install -r requirements.txt
 2. ANTHROPIC_API_KEY環境変数を設定（任意・なしでもサンプル動作）
-3. python keihi_server.py
-4. ブラウザで http://localhost:5001 を開く
+3. gunicorn keihi_server:app（設定は gunicorn.conf.py / geventワーカー）
+   ※ 開発時は python keihi_server.py でも起動できる
+4. ブラウザで http://localhost:10000 を開く
 """
 
 from flask import Flask, request, jsonify, send_file
 from flask_cors import CORS
-import threading, os, base64, json, re
+from werkzeug.utils import secure_filename
+import threading, os, io, base64, hashlib, re, time, uuid
+import orjson
+import anthropic
+from concurrent.futures import ThreadPoolExecutor
+from collections import Counter
 from pathlib import Path
 from PIL import Image
-from openpyxl import Workbook
-from openpyxl.styles import Font, PatternFill, Alignment, Border, Side
-from openpyxl.chart import BarChart, Reference
-from openpyxl.utils import get_column_letter
+import xlsxwriter
 
 app = Flask(__name__, static_folder=".")
 CORS(app)
 
-status = {"step": 0, "done": False, "error": None, "count": 0, "total": 0, "categories": 0}
+# ジョブごとの進捗（job_id -> status）。同時に複数の /analyze が来ても互いに上書きしない
+JOBS = {}
+_JOBS_LOCK = threading.Lock()
+JOB_TTL = 60 * 60  # 終了したジョブはこの秒数が過ぎたら破棄する
+
+def new_status():
+    return {"step": 0, "done": False, "error": None, "count": 0, "total": 0, "categories": 0,
+            "created": time.time()}
+
+def prune_jobs():
+    """TTLを過ぎた終了済みジョブを出力ファイルごと削除する（JOBSが増え続けないように）"""
+    cutoff = time.time() - JOB_TTL
+    with _JOBS_LOCK:
+        expired = [job_id for job_id, st in JOBS.items()
+                   if (st["done"] or st["error"]) and st["created"] < cutoff]
+        for job_id in expired:
+            output_file = JOBS.pop(job_id).get("output_file")
+            if output_file:
+                Path(output_file).unlink(missing_ok=True)
+
 UPLOAD_DIR = Path("uploads_temp")
 UPLOAD_DIR.mkdir(exist_ok=True)
+CACHE_DIR = Path(".keihi_cache")
+CACHE_DIR.mkdir(exist_ok=True)
+
+# Claude API同時呼び出し数（Tier-1のRPMに合わせる）
+API_CONCURRENCY = 10
+# 同時実行中の全ジョブで共有する上限（ジョブごとに数えると N ジョブで N 倍になる）
+_API_SEMAPHORE = threading.BoundedSemaphore(API_CONCURRENCY)
+API_MAX_RETRIES = 4
+MAX_IMAGE_EDGE = 1568
+SMALL_JPEG_BYTES = 1_500_000  # これ以下のJPEGは再エンコードせずそのまま送る
+
+# Claudeクライアントはプロセスで1つだけ作り、HTTP接続（keep-alive・TLSセッション）を全レシートで使い回す
+_API_KEY = os.environ.get("ANTHROPIC_API_KEY")
+_CLIENT = None
+if _API_KEY:
+    try:
+        # 再試行は read_receipt_with_claude 側のループに一本化する（SDKの再試行と重ねない）
+        _CLIENT = anthropic.Anthropic(api_key=_API_KEY, max_retries=0)
+    except Exception as e:
+        # 作れなくてもアプリ自体は起動させ、読み取りはサンプル動作にフォールバックする
+        print(f"Claude client init error: {e}")
 
 # カテゴリ自動判定
 CATEGORY_RULES = {
@@ -36,6 +79,26 @@ CATEGORY_RULES = {
     "通信費": ["ドコモ", "au", "ソフトバンク", "通信", "インターネット"],
 }
 
+# 全キーワードを1つのオートマトンにまとめ、テキストを1回走査するだけで判定する
+# 値はCATEGORY_RULES内での優先順位（小さいほど優先）
+_CATEGORY_ORDER = list(CATEGORY_RULES)
+_KW2CAT = {}
+for _i, _keywords in enumerate(CATEGORY_RULES.values()):
+    for _kw in _keywords:
+        _KW2CAT.setdefault(_kw, _i)
+
+try:
+    import ahocorasick
+    _AC = ahocorasick.Automaton()
+    for _kw, _i in _KW2CAT.items():
+        _AC.add_word(_kw, _i)
+    _AC.make_automaton()
+except ImportError:
+    # pyahocorasickがない環境では正規表現の選択一本で代用する
+    # 先読みにして重なったキーワードも拾い、選択肢は優先順に並べる
+    _AC = None
+    _KW_RE = re.compile("(?=(" + "|".join(re.escape(k) for k in _KW2CAT) + "))")
+
 FREEE_ACCOUNT_MAP = {
     "交通費": "旅費交通費",
     "飲食費": "交際費",
@@ -46,10 +109,10 @@ FREEE_ACCOUNT_MAP = {
     "その他": "雑費",
 }
 
-def get_output_filename(fmt):
-    """タイムスタンプ付きのユニークなファイル名を生成"""
+def get_output_filename(fmt, job_id):
+    """タイムスタンプ付きのユニークなファイル名を生成（同じ秒の別ジョブと衝突しないようjob_idも付ける）"""
     import datetime
-    ts = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
+    ts = datetime.datetime.now().strftime("%Y%m%d_%H%M%S") + "_" + job_id[:8]
     names = {
         "excel": f"expense_report_{ts}.xlsx",
         "csv":   f"expense_report_{ts}.csv",
@@ -59,40 +122,103 @@ def get_output_filename(fmt):
     return names.get(fmt, f"expense_report_{ts}.xlsx")
 
 def guess_category(text):
-    for cat, keywords in CATEGORY_RULES.items():
-        for kw in keywords:
-            if kw in text:
-                return cat
-    return "その他"
+    if _AC is not None:
+        hits = (i for _, i in _AC.iter(text))
+    else:
+        hits = (_KW2CAT[m.group(1)] for m in _KW_RE.finditer(text))
+    best = min(hits, default=None)
+    return _CATEGORY_ORDER[best] if best is not None else "その他"
+
+# 金額抽出パターン（優先順）。呼び出しごとにパースし直さないよう先にコンパイルしておく
+_AMOUNT_PATTERNS = [re.compile(p) for p in (
+    r'領収額[^\d]*(\d[\d,]+)円',
+    r'現金[^\d]*(\d[\d,]+)円',
+    r'合計[^\d]*(\d[\d,]+)円',
+    r'(\d[\d,]+)円',
+)]
 
 def extract_amount(text):
-    patterns = [
-        r'領収額[^\d]*(\d[\d,]+)円',
-        r'現金[^\d]*(\d[\d,]+)円',
-        r'合計[^\d]*(\d[\d,]+)円',
-        r'(\d[\d,]+)円',
-    ]
-    for p in patterns:
-        m = re.search(p, text)
+    for p in _AMOUNT_PATTERNS:
+        m = p.search(text)
         if m:
             return int(m.group(1).replace(',', ''))
     return 0
 
-def image_to_base64(path):
-    with open(path, "rb") as f:
-        return base64.standard_b64encode(f.read()).decode()
-
-def read_receipt_with_claude(image_path):
-    """Claude APIで領収書を読み取る（APIキーがある場合）"""
-    api_key = os.environ.get("ANTHROPIC_API_KEY")
-    print(f"=== API KEY: {api_key[:15] if api_key else 'NOT FOUND'} ===")
-    if not api_key:
+CLAUDE_MODEL = "claude-sonnet-4-6"
+RECEIPT_PROMPT = "この画像またはPDFに写っている領収書・レシートをすべて読み取ってください。【重要ルール】①金額は合計・小計・税込合計を使う。お釣り・お預り・PayPayなど支払い関連の金額は絶対に使わない。②レシートが1枚だけならJSONオブジェクト1つ、複数枚写っていたらJSON配列で返す。③店名がない場合は内容から推測する。フォーマット（1枚）: {\"店名\": \"\", \"日付\": \"\", \"金額\": 0, \"カテゴリ\": \"\", \"支払方法\": \"\", \"備考\": \"\"}　フォーマット（複数）: [{\"店名\": \"\", ...}, {\"店名\": \"\", ...}]　JSONのみ返してください。"
+# 読み取り結果はモデルとプロンプトにも依存するので、どちらかを変えたら古いキャッシュは使わない
+_CACHE_VERSION = hashlib.sha256(f"{CLAUDE_MODEL}\n{RECEIPT_PROMPT}".encode("utf-8")).hexdigest()[:12]
+
+def _receipt_cache_path(image_path, digest=None):
+    """画像内容のSHA-256（＋モデル・プロンプトのバージョン）をキーにしたキャッシュファイルのパス
+    （digest が分かっていれば再計算しない）"""
+    if digest is None:
+        with open(image_path, "rb") as f:
+            digest = hashlib.file_digest(f, "sha256").hexdigest()
+    return CACHE_DIR / f"{digest}_{_CACHE_VERSION}.json"
+
+def _is_valid_reading(result):
+    """レシート1枚分の dict か、dict だけからなる空でない list なら True"""
+    if isinstance(result, dict):
+        return bool(result)
+    return isinstance(result, list) and bool(result) and all(isinstance(r, dict) for r in result)
+
+def _read_cache(cache_path):
+    """キャッシュ済みの読み取り結果。無い・壊れている・形が不正な場合は None（キャッシュミス扱い）"""
+    try:
+        result = orjson.loads(cache_path.read_bytes())
+    except (OSError, orjson.JSONDecodeError):
         return None
+    return result if _is_valid_reading(result) else None
+
+def _write_cache(cache_path, result):
+    """一時ファイルに書いてから os.replace で差し替え、書きかけのキャッシュを残さない"""
+    tmp = cache_path.with_name(f"{cache_path.name}.{uuid.uuid4().hex}.tmp")
+    try:
+        tmp.write_bytes(orjson.dumps(result))
+        os.replace(tmp, cache_path)
+    except OSError as e:
+        print(f"Cache write error: {e}")
+        tmp.unlink(missing_ok=True)
+
+def _parse_claude_json(text):
+    """Claudeの返答からJSON（配列 or オブジェクト）を取り出す"""
+    # まず配列（複数レシート）を試みる
+    match = re.search(r'\[.*?\]', text, re.DOTALL)
+    if match:
+        try:
+            result = orjson.loads(match.group())
+            if isinstance(result, list) and len(result) > 0:
+                return result  # リストをそのまま返す
+        except:
+            pass
+    # 次に単一オブジェクトを試みる
+    match = re.search(r'\{[^{}]*\}', text)
+    if match:
+        try:
+            return orjson.loads(match.group())
+        except:
+            pass
+    match = re.search(r'\{.*?\}', text, re.DOTALL)
+    if match:
+        try:
+            return orjson.loads(match.group())
+        except:
+            pass
+    return None
 
+def read_receipt_with_claude(image_path, digest=None):
+    """Claude APIで領収書を読み取る（APIキーがある場合）。digest はアップロード時に求めたSHA-256"""
     try:
-        import anthropic
-        client = anthropic.Anthropic(api_key=api_key)
-        
+        # 同じ画像は以前の読み取り結果を再利用する（結果は画像内容だけで決まる）
+        cache_path = _receipt_cache_path(image_path, digest)
+        cached = _read_cache(cache_path)
+        if cached is not None:
+            return cached
+
+        if _CLIENT is None:
+            return None
+
         image_path_str = str(image_path)
         if image_path_str.lower().endswith(".pdf"):
             with open(image_path_str, "rb") as f:
@@ -101,46 +227,51 @@ def read_receipt_with_claude(image_path):
             source = {"type": "base64", "media_type": media_type, "data": b64}
             content_type = "document"
         else:
-            img = Image.open(image_path_str)
-            img.save(image_path_str + "_resized.jpg", "JPEG", quality=85)
-            b64 = image_to_base64(image_path_str + "_resized.jpg")
+            path = Path(image_path_str)
+            data = None
+            # 小さいJPEGはそのまま送れるので、デコード→縮小→再エンコードを丸ごと省略する
+            if path.suffix.lower() in (".jpg", ".jpeg") and path.stat().st_size <= SMALL_JPEG_BYTES:
+                data = path.read_bytes()
+                if not data.startswith(b"\xff\xd8\xff"):  # 拡張子だけJPEGの別形式は通常経路へ
+                    data = None
+            if data is None:
+                img = Image.open(image_path_str)
+                # Claudeは長辺1568px程度で十分なので、エンコード前に縮小しておく
+                img.thumbnail((MAX_IMAGE_EDGE, MAX_IMAGE_EDGE), Image.LANCZOS)
+                # 一時ファイルを経由せずメモリ上でエンコードする
+                buf = io.BytesIO()
+                img.save(buf, "JPEG", quality=85, optimize=True, progressive=False)
+                data = buf.getvalue()
+            b64 = base64.standard_b64encode(data).decode()
             source = {"type": "base64", "media_type": "image/jpeg", "data": b64}
             content_type = "image"
 
-        response = client.messages.create(
-            model="claude-sonnet-4-6",
-            max_tokens=1500,
-            messages=[{
-                "role": "user",
-                "content": [
-                    {"type": content_type, "source": source},
-                    {"type": "text", "text": "この画像またはPDFに写っている領収書・レシートをすべて読み取ってください。【重要ルール】①金額は合計・小計・税込合計を使う。お釣り・お預り・PayPayなど支払い関連の金額は絶対に使わない。②レシートが1枚だけならJSONオブジェクト1つ、複数枚写っていたらJSON配列で返す。③店名がない場合は内容から推測する。フォーマット（1枚）: {\"店名\": \"\", \"日付\": \"\", \"金額\": 0, \"カテゴリ\": \"\", \"支払方法\": \"\", \"備考\": \"\"}　フォーマット（複数）: [{\"店名\": \"\", ...}, {\"店名\": \"\", ...}]　JSONのみ返してください。"}
-                ]
-            }]
-        )
-        text = response.content[0].text
-        # まず配列（複数レシート）を試みる
-        match = re.search(r'\[.*?\]', text, re.DOTALL)
-        if match:
+        # 429（レート制限）・過負荷/5xx・接続エラーは指数バックオフで再試行
+        # 待機はセマフォの外で行い、待っている間にAPI枠を占有しない
+        for attempt in range(API_MAX_RETRIES):
             try:
-                result = json.loads(match.group())
-                if isinstance(result, list) and len(result) > 0:
-                    return result  # リストをそのまま返す
-            except:
-                pass
-        # 次に単一オブジェクトを試みる
-        match = re.search(r'\{[^{}]*\}', text)
-        if match:
-            try:
-                return json.loads(match.group())
-            except:
-                pass
-        match = re.search(r'\{.*?\}', text, re.DOTALL)
-        if match:
-            try:
-                return json.loads(match.group())
-            except:
-                pass
+                with _API_SEMAPHORE:
+                    response = _CLIENT.messages.create(
+                        model=CLAUDE_MODEL,
+                        max_tokens=1500,
+                        messages=[{
+                            "role": "user",
+                            "content": [
+                                {"type": content_type, "source": source},
+                                {"type": "text", "text": RECEIPT_PROMPT}
+                            ]
+                        }]
+                    )
+                break
+            except (anthropic.RateLimitError, anthropic.InternalServerError, anthropic.APIConnectionError):
+                if attempt == API_MAX_RETRIES - 1:
+                    raise
+                time.sleep(2 ** attempt)
+        result = _parse_claude_json(response.content[0].text)
+        if not _is_valid_reading(result):
+            return None  # 想定外の形（文字列の配列など）はキャッシュせずフォールバックへ
+        _write_cache(cache_path, result)
+        return result
     except Exception as e:
         print(f"Claude API error: {e}")
     return None
@@ -157,10 +288,8 @@ def fallback_read(image_path, filename):
 
 # ★修正: output_file を引数で受け取るように変更（status依存をなくす）
 
-def make_freee_csv(receipts, month, applicant, output_file):
+def make_freee_csv(receipts, agg, month, applicant, output_file):
     import csv
-    total = 0
-    cats = set()
     
     INCOME_EXPENSE_MAP = {
         "旅費交通費": "支出",
@@ -169,44 +298,34 @@ def make_freee_csv(receipts, month, applicant, output_file):
         "通信費": "支出",
         "雑費": "支出",
     }
-    
+    suffix = f"（{applicant}）" if applicant else ""
+
+    rows = []
+    for r in receipts:
+        account = FREEE_ACCOUNT_MAP.get(r.get("カテゴリ", "その他"), "雑費")
+        rows.append([
+            r.get("日付", "").replace("-", "/"), INCOME_EXPENSE_MAP.get(account, "支出"), account,
+            "課税仕入10%", str(r.get("金額", 0)), "現金", r.get("店名", "") + suffix
+        ])
     with open(output_file, "w", newline="", encoding="utf-8-sig") as f:
         writer = csv.writer(f)
         writer.writerow([
             "発生日", "収支区分", "勘定科目", "税区分", "金額", "決済口座", "摘要"
         ])
-        for r in receipts:
-            cat = r.get("カテゴリ", "その他")
-            account = FREEE_ACCOUNT_MAP.get(cat, "雑費")
-            income_expense = INCOME_EXPENSE_MAP.get(account, "支出")
-            amt = r.get("金額", 0)
-            date = r.get("日付", "").replace("-", "/")
-            memo = r.get("店名", "")
-            if applicant:
-                memo += f"（{applicant}）"
-            writer.writerow([
-                date, income_expense, account, "課税仕入10%", str(amt), "現金", memo
-            ])
-            total += amt
-            cats.add(cat)
-    return total, len(cats)
-
-def make_csv(receipts, month, applicant, output_file):
+        writer.writerows(rows)
+
+def make_csv(receipts, agg, month, applicant, output_file):
     import csv
-    total = 0
-    cats = set()
+    rows = [[i, r.get("店名",""), r.get("日付",""), r.get("カテゴリ",""),
+             r.get("金額",0), r.get("支払方法","現金"), r.get("備考","")]
+            for i, r in enumerate(receipts, 1)]
     with open(output_file, "w", newline="", encoding="utf-8-sig") as f:
         writer = csv.writer(f)
         writer.writerow(["No.", "店名", "日付", "カテゴリ", "金額（円）", "支払方法", "備考"])
-        for i, r in enumerate(receipts, 1):
-            writer.writerow([i, r.get("店名",""), r.get("日付",""), r.get("カテゴリ",""),
-                             r.get("金額",0), r.get("支払方法","現金"), r.get("備考","")])
-            total += r.get("金額", 0)
-            cats.add(r.get("カテゴリ","その他"))
-        writer.writerow(["合計", "", "", "", total, "", ""])
-    return total, len(cats)
-
-def make_pdf(receipts, month, applicant, output_file):
+        writer.writerows(rows)
+        writer.writerow(["合計", "", "", "", agg["total"], "", ""])
+
+def make_pdf(receipts, agg, month, applicant, output_file):
     from reportlab.lib.pagesizes import A4
     from reportlab.platypus import SimpleDocTemplate, Table, TableStyle, Paragraph, Spacer
     from reportlab.lib.styles import getSampleStyleSheet
@@ -225,14 +344,10 @@ def make_pdf(receipts, month, applicant, output_file):
     story.append(Spacer(1, 16))
 
     data = [["No.", "店名", "日付", "カテゴリ", "金額（円）", "支払方法"]]
-    total = 0
-    cats = set()
     for i, r in enumerate(receipts, 1):
         data.append([str(i), r.get("店名",""), r.get("日付",""), r.get("カテゴリ",""),
                      f"{r.get('金額',0):,}", r.get("支払方法","現金")])
-        total += r.get("金額", 0)
-        cats.add(r.get("カテゴリ","その他"))
-    data.append(["合計", "", "", "", f"{total:,}", ""])
+    data.append(["合計", "", "", "", f"{agg['total']:,}", ""])
 
     table = Table(data, colWidths=[30, 100, 65, 65, 65, 65])
     table.setStyle(TableStyle([
@@ -248,131 +363,130 @@ def make_pdf(receipts, month, applicant, output_file):
     ]))
     story.append(table)
     doc.build(story)
-    return total, len(cats)
-
-def make_excel(receipts, month, applicant, output_file):
-    wb = Workbook()
-    ws = wb.active
-    ws.title = "経費一覧"
 
-    thin = Side(style="thin", color="DDDDDD")
-    bdr = Border(left=thin, right=thin, top=thin, bottom=thin)
+# Excelのセル書式（xlsxwriterのadd_format用）
+_XL_BASE = {"font_name": "Arial", "font_size": 10, "align": "center", "valign": "vcenter",
+            "border": 1, "border_color": "#DDDDDD"}
+_XL_FORMATS = {
+    "title":        {"bold": True, "font_size": 13, "font_color": "#2D6A4F", "bg_color": "#E8F5EE",
+                     "border": 0, "valign": None},
+    "header":       {"bold": True, "font_color": "#FFFFFF", "bg_color": "#2D6A4F"},
+    "data":         {},
+    "total":        {"bold": True, "font_size": 11, "bg_color": "#E8F5EE", "valign": None},
+    "total_amount": {"bold": True, "font_size": 12, "font_color": "#2D6A4F", "bg_color": "#E8F5EE",
+                     "valign": None, "num_format": "#,##0"},
+}
 
-    ws.merge_cells("A1:G1")
-    ws["A1"].value = f"経費精算書　{month}　申請者：{applicant or '未記入'}"
-    ws["A1"].font = Font(name="Arial", bold=True, size=13, color="2D6A4F")
-    ws["A1"].alignment = Alignment(horizontal="center")
-    ws["A1"].fill = PatternFill("solid", start_color="E8F5EE")
-    ws.row_dimensions[1].height = 32
+def make_excel(receipts, agg, month, applicant, output_file):
+    # constant_memoryモード: 行を書いたそばからファイルへ流す（現在行しかメモリに持たない）
+    wb = xlsxwriter.Workbook(output_file, {"constant_memory": True, "strings_to_numbers": False})
+    ws = wb.add_worksheet("経費一覧")
+
+    # 書式はワークブックごとに1種類1回だけ作って使い回す
+    formats = {}
+    def fmt(kind, left=False, num=False):
+        key = (kind, left, num)
+        if key not in formats:
+            props = {k: v for k, v in {**_XL_BASE, **_XL_FORMATS[kind]}.items() if v is not None}
+            if left:
+                props["align"] = "left"
+            if num:
+                props["num_format"] = "#,##0"
+            formats[key] = wb.add_format(props)
+        return formats[key]
 
     headers = ["No.", "店名", "日付", "カテゴリ", "金額（円）", "支払方法", "備考"]
     widths =  [5,     24,    14,    14,          13,          12,          28]
-    for i, (h, w) in enumerate(zip(headers, widths), 1):
-        c = ws.cell(row=2, column=i)
-        c.value = h
-        c.font = Font(name="Arial", bold=True, color="FFFFFF", size=10)
-        c.fill = PatternFill("solid", start_color="2D6A4F")
-        c.alignment = Alignment(horizontal="center", vertical="center")
-        c.border = bdr
-        ws.column_dimensions[get_column_letter(i)].width = w
-    ws.row_dimensions[2].height = 22
-
-    total = 0
+    for i, w in enumerate(widths):
+        ws.set_column(i, i, w)
+
+    ws.set_row(0, 32)
+    ws.merge_range(0, 0, 0, 6, f"経費精算書　{month}　申請者：{applicant or '未記入'}", fmt("title"))
+
+    ws.set_row(1, 22)
+    ws.write_row(1, 0, headers, fmt("header"))
+
     for i, r in enumerate(receipts, 1):
-        row = i + 2
-        bg = "FFFFFF" if i % 2 == 1 else "F4FAF6"
+        row = i + 1
         vals = [i, r.get("店名",""), r.get("日付",""), r.get("カテゴリ",""), r.get("金額",0), r.get("支払方法","現金"), r.get("備考","")]
-        for col, val in enumerate(vals, 1):
-            c = ws.cell(row=row, column=col)
-            c.value = val
-            c.font = Font(name="Arial", size=10)
-            c.fill = PatternFill("solid", start_color=bg)
-            c.alignment = Alignment(horizontal="center" if col != 2 else "left", vertical="center")
-            c.border = bdr
-            if col == 5: c.number_format = '#,##0'
-        total += r.get("金額", 0)
-        ws.row_dimensions[row].height = 20
-
-    tr = len(receipts) + 3
-    ws.merge_cells(f"A{tr}:D{tr}")
-    c = ws.cell(row=tr, column=1)
-    c.value = "合計"
-    c.font = Font(name="Arial", bold=True, size=11)
-    c.fill = PatternFill("solid", start_color="E8F5EE")
-    c.alignment = Alignment(horizontal="center")
-    c.border = bdr
-
-    c = ws.cell(row=tr, column=5)
-    c.value = f"=SUM(E3:E{tr-1})"
-    c.font = Font(name="Arial", bold=True, size=12, color="2D6A4F")
-    c.fill = PatternFill("solid", start_color="E8F5EE")
-    c.alignment = Alignment(horizontal="center")
-    c.number_format = '#,##0'
-    c.border = bdr
-
-    for col in [6,7]:
-        ws.cell(row=tr, column=col).fill = PatternFill("solid", start_color="E8F5EE")
-        ws.cell(row=tr, column=col).border = bdr
-    ws.row_dimensions[tr].height = 26
-
-    ws2 = wb.create_sheet("カテゴリ別集計")
-    cat_totals = {}
+        ws.set_row(row, 20)
+        for col, val in enumerate(vals):
+            ws.write(row, col, val, fmt("data", left=(col == 1), num=(col == 4)))
+    # 縞模様はセルごとに塗らず、条件付き書式1つでExcel側に描画させる
+    if receipts:
+        ws.conditional_format(2, 0, len(receipts) + 1, 6, {
+            "type": "formula", "criteria": "=MOD(ROW(),2)=0",
+            "format": wb.add_format({"bg_color": "#F4FAF6"}),
+        })
+
+    tr = len(receipts) + 2
+    ws.set_row(tr, 26)
+    ws.merge_range(tr, 0, tr, 3, "合計", fmt("total"))
+    ws.write_formula(tr, 4, f"=SUM(E3:E{tr})", fmt("total_amount"), agg["total"])
+    ws.write_blank(tr, 5, None, fmt("total"))
+    ws.write_blank(tr, 6, None, fmt("total"))
+
+    ws2 = wb.add_worksheet("カテゴリ別集計")
+    cat_totals = agg["cat_totals"]
+    ws2.write_row(0, 0, ["カテゴリ", "金額（円）"])
+    for row, (cat, amt) in enumerate(cat_totals.items(), 1):
+        ws2.write_row(row, 0, [cat, amt])
+
+    if cat_totals:
+        n = len(cat_totals)
+        chart = wb.add_chart({"type": "column"})
+        chart.add_series({
+            "name":       ["カテゴリ別集計", 0, 1],
+            "categories": ["カテゴリ別集計", 1, 0, n, 0],
+            "values":     ["カテゴリ別集計", 1, 1, n, 1],
+            "fill":       {"color": "#52B788"},
+        })
+        chart.set_title({"name": "カテゴリ別経費"})
+        chart.set_y_axis({"name": "金額（円）"})
+        chart.set_style(10)
+        chart.set_size({"width": 605, "height": 378})  # 16cm x 10cm
+        ws2.insert_chart("D2", chart)
+
+    wb.close()
+
+def aggregate_receipts(receipts):
+    """合計・カテゴリ別合計を1回の走査で求める（各make_xxx()で共有する）"""
+    cat_totals = Counter()
     for r in receipts:
-        cat = r.get("カテゴリ","その他")
-        cat_totals[cat] = cat_totals.get(cat, 0) + r.get("金額", 0)
-
-    ws2.append(["カテゴリ", "金額（円）"])
-    for cat, amt in cat_totals.items():
-        ws2.append([cat, amt])
-
-    chart = BarChart()
-    chart.type = "col"
-    chart.title = "カテゴリ別経費"
-    chart.y_axis.title = "金額（円）"
-    chart.style = 10
-    chart.width = 16
-    chart.height = 10
-    data = Reference(ws2, min_col=2, max_col=2, min_row=1, max_row=len(cat_totals)+1)
-    cats_ref = Reference(ws2, min_col=1, min_row=2, max_row=len(cat_totals)+1)
-    chart.add_data(data, titles_from_data=True)
-    chart.set_categories(cats_ref)
-    chart.series[0].graphicalProperties.solidFill = "52B788"
-    ws2.add_chart(chart, "D2")
-
-    wb.save(output_file)
-    return total, len(cat_totals)
-
-def process_files(files_data, month, applicant):
-    global status
+        cat_totals[r.get("カテゴリ","その他")] += r.get("金額", 0)
+    return {"total": sum(cat_totals.values()), "cat_totals": dict(cat_totals), "n_cats": len(cat_totals)}
+
+def _finalize(r):
+    """カテゴリ未設定・「その他」のレシートを店名と備考から自動分類する"""
+    if not r.get("カテゴリ") or r["カテゴリ"] == "その他":
+        r["カテゴリ"] = guess_category(r.get("店名","") + r.get("備考",""))
+    return r
+
+def process_files(job_id, saved_paths, month, applicant):
+    """saved_paths: /analyze で保存済みの [(元のファイル名, 保存先Path, SHA-256)]"""
+    status = JOBS[job_id]
     try:
         receipts = []
 
-        status["step"] = 1
-        saved_paths = []
-        import time
-        for name, data in files_data:
-            ts = str(int(time.time() * 1000))
-            unique_name = f"{ts}_{name}"
-            path = UPLOAD_DIR / unique_name
-            path.write_bytes(data)
-            saved_paths.append((name, path))
+        status["step"] = 1  # ファイル保存は /analyze 側で完了済み
 
         status["step"] = 2
-        for name, path in saved_paths:
-            result = read_receipt_with_claude(path)
+        # API待ちが支配的なので並列に投げる（結果の順序はアップロード順のまま）
+        with ThreadPoolExecutor(max_workers=API_CONCURRENCY) as pool:
+            results = list(pool.map(read_receipt_with_claude,
+                                    [path for _, path, _ in saved_paths], [d for _, _, d in saved_paths]))
+        for (name, path, _), result in zip(saved_paths, results):
             if not result:
                 result = fallback_read(path, name)
             # 複数レシートが1枚の画像に写っていた場合はリストで返る
+            # カテゴリ判定も読み取り結果の取り込みと同じループで済ませる
             if isinstance(result, list):
-                receipts.extend(result)
+                receipts.extend(_finalize(r) for r in result)
             else:
-                receipts.append(result)
+                receipts.append(_finalize(result))
 
-        status["step"] = 3
-        for r in receipts:
-            if not r.get("カテゴリ") or r["カテゴリ"] == "その他":
-                text = r.get("店名","") + r.get("備考","")
-                r["カテゴリ"] = guess_category(text)
+        status["step"] = 3  # カテゴリ分類は Step 2 で完了済み
+        agg = aggregate_receipts(receipts)
 
         status["step"] = 4
         if not month and receipts:
@@ -384,23 +498,51 @@ def process_files(files_data, month, applicant):
         # ★修正: output_fileを先に確定してからmake_xxx()に引数で渡す
         status["step"] = 5
         fmt = status.get("format", "excel")
-        output_file = get_output_filename(fmt)   # ここで確定
+        output_file = get_output_filename(fmt, job_id)   # ここで確定
         status["output_file"] = output_file       # statusにも保存（download用）
 
         if fmt == "csv":
-            total, cats = make_csv(receipts, month, applicant, output_file)
+            make_csv(receipts, agg, month, applicant, output_file)
         elif fmt == "freee":
-            total, cats = make_freee_csv(receipts, month, applicant, output_file)
+            make_freee_csv(receipts, agg, month, applicant, output_file)
         elif fmt == "pdf":
-            total, cats = make_pdf(receipts, month, applicant, output_file)
+            make_pdf(receipts, agg, month, applicant, output_file)
         else:
-            total, cats = make_excel(receipts, month, applicant, output_file)
+            make_excel(receipts, agg, month, applicant, output_file)
 
-        status.update({"done": True, "count": len(receipts), "total": total, "categories": cats})
+        status.update({"done": True, "count": len(receipts), "total": agg["total"], "categories": agg["n_cats"]})
 
     except Exception as e:
         status["error"] = str(e)
 
+def upload_path(name, digest):
+    """アップロードの保存先。ディレクトリ成分（../ など）は取り除き、内容のSHA-256で一意にする"""
+    stem, ext = os.path.splitext(Path(name.replace("\\", "/")).name)
+    ext = secure_filename(ext.lstrip("."))
+    # 日本語だけのファイル名は secure_filename で空になるが、拡張子は残して判定に使う
+    safe = (secure_filename(stem) or "upload") + (f".{ext}" if ext else "")
+    return UPLOAD_DIR / f"{digest}_{safe}"
+
+def save_upload(f):
+    """アップロードを内容ハッシュ名のパスに保存し (path, digest) を返す。
+    先にストリームをハッシュし、同じ内容のファイルが既にあればディスクへの書き込みを省略する"""
+    digest = hashlib.file_digest(f.stream, "sha256").hexdigest()
+    f.stream.seek(0)
+    path = upload_path(f.filename, digest)
+    if not path.exists():
+        # 書きかけのファイルを他のジョブに見せないよう、一時ファイルから os.replace で置く
+        tmp = UPLOAD_DIR / f".{uuid.uuid4().hex}.tmp"
+        try:
+            f.save(tmp)
+            os.replace(tmp, path)
+        finally:
+            tmp.unlink(missing_ok=True)
+    return path, digest
+
+def json_response(obj, code=200):
+    """orjsonでシリアライズしたJSONレスポンス（ポーリングで頻繁に呼ばれる経路用）"""
+    return app.response_class(orjson.dumps(obj), status=code, mimetype="application/json")
+
 @app.route("/")
 def index():
     return send_file("keihi_app.html")
@@ -409,46 +551,48 @@ def index():
 def landing():
     return send_file("landing.html")
 
-processing_lock = threading.Lock()
-
 @app.route("/analyze", methods=["POST"])
 def analyze():
-    global status
-    if not processing_lock.acquire(blocking=False):
-        return jsonify({"ok": False, "error": "処理中です"}), 429
+    prune_jobs()
 
-    # ★statusを完全リセット（output_fileも含めてクリア）
-    status = {"step": 0, "done": False, "error": None, "count": 0, "total": 0, "categories": 0}
-    files_data = [(f.filename, f.read()) for f in request.files.getlist("files")]
+    # メモリに読み込まず、アップロードをそのままディスクへストリーム保存
+    # 同じ内容のファイルが既に保存済みなら書き込みを省略する
+    saved_paths = [(f.filename, *save_upload(f)) for f in request.files.getlist("files")]
     applicant = request.form.get("applicant", "")
     month = ""
-    status["format"] = request.form.get("format", "excel")
 
-    def run_and_release():
-        try:
-            process_files(files_data, month, applicant)
-        finally:
-            processing_lock.release()
+    # 保存が終わってからジョブを登録する（保存で例外が出ても未完了のジョブを残さない）
+    job_id = uuid.uuid4().hex
+    status = new_status()
+    status["format"] = request.form.get("format", "excel")
+    with _JOBS_LOCK:
+        JOBS[job_id] = status
 
-    threading.Thread(target=run_and_release).start()
-    return jsonify({"ok": True})
+    threading.Thread(target=process_files, args=(job_id, saved_paths, month, applicant)).start()
+    return json_response({"ok": True, "job_id": job_id})
 
 @app.route("/status_expense")
 def get_status():
-    return jsonify(status)
+    status = JOBS.get(request.args.get("job", ""))
+    if status is None:
+        return json_response({"error": "ジョブが見つかりません"}, 404)
+    return json_response(status)
 
 @app.route("/download_expense")
 def download():
+    status = JOBS.get(request.args.get("job", ""), {})
     output_file = status.get("output_file", "")
     path = Path(output_file)
-    if path.exists():
+    if output_file and path.exists():
         # タイムスタンプ付きのファイル名をそのままダウンロード名に使う
-        return send_file(str(path), as_attachment=True, download_name=path.name)
+        # 相対パスはFlaskのroot_path基準で解決されるため、起動ディレクトリ基準の絶対パスにする
+        return send_file(str(path.resolve()), as_attachment=True, download_name=path.name)
     return jsonify({"error": "ファイルが見つかりません"}), 404
 
 if __name__ == "__main__":
+    # 開発用サーバー。本番は gunicorn keihi_server:app で起動する
     print("🧾 KeihiAI 起動中...")
-    print("👉 ブラウザで http://localhost:5001 を開いてください")
+    print("👉 ブラウザで http://localhost:10000 を開いてください")
     print("💡 Claude APIキーを設定するとAI読み取りが有効になります")
     print("   例: set ANTHROPIC_API_KEY=sk-ant-...")
     app.run(host="0.0.0.0", debug=False, port=10000)